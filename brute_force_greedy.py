@@ -1,33 +1,38 @@
 # from __future__ import print_function
 from instance_parser import *
-from copy import deepcopy
 
 
 def brute_force_greedy(jobs, solution, qpu=False, num_reads=2000, max_time=None, window_size=5, chain_strength=2, times=20):
     if max_time is None:
         max_time = get_result(jobs, solution) + 3
+    windows = {}  # find_time_window results per window start
     for iteration_number in range(times):
         print(iteration_number)
         for i in range(max_time - window_size):
-            info = find_time_window(jobs, solution, i, i + window_size)
+            if i not in windows:
+                windows[i] = find_time_window(jobs, solution, i, i + window_size)
+            info = windows[i]
             new_jobs, indexes, disable_till, disable_since, disabled_variables = info
 
             if not bool(new_jobs):  # if new_jobs dict is empty
                 continue
 
+            # best of a few greedy schedules of the sub-instance
             task_times = solve_greedily(new_jobs)
-            for i in range(10):
+            for _ in range(10):
                 new_task_times = solve_greedily(new_jobs)
                 if get_result(new_jobs, new_task_times) < get_result(new_jobs, task_times):
-                    task_times = deepcopy(new_task_times)
+                    task_times = new_task_times
+
+            # greedy schedules may run past the end of the window
+            end = i + max(window_size, get_result(new_jobs, task_times))
 
             # improving original solution
-            sol_found = deepcopy(solution)
-            for job, times in task_times.items():
-                for j in range(len(times)):
-                    if sol_found[job][indexes[job][j]] != task_times[job][j] + i:
-                        sol_found[job][indexes[job][j]
-                                       ] = task_times[job][j] + i
-            if checkValidity(jobs, sol_found):
+            task_times = {(job, j): time for job, times in task_times.items()
+                          for j, time in enumerate(times)}
+            sol_found = apply_window_solution(jobs, solution, task_times,
+                                              indexes, i)
+            if sol_found is not None:
                 solution = sol_found
+                invalidate_windows(windows, i, end, window_size)
                 yield solution, i  # solution and which timepoint the frame starts on
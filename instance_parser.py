@@ -1,5 +1,6 @@
 from collections import defaultdict
 from copy import deepcopy
+from functools import lru_cache
 from job_shop_scheduler import get_label, Task
 from math import inf
 from pprint import pprint
@@ -7,16 +8,28 @@ from random import shuffle
 
 
 def readInstance(path: str) -> dict:
+    """Reads an instance file.
+
+    The file is parsed only once per path, later calls return a fresh copy
+    of the cached instance, which callers are free to modify.
+    """
     job_dict = defaultdict(list)
+    for job, operations in _read_instance(path):
+        job_dict[job] = list(operations)
+    return job_dict
+
+
+@lru_cache(maxsize=8)
+def _read_instance(path: str) -> tuple:
+    jobs = []
     with open(path) as f:
         f.readline()
         for i, line in enumerate(f):
             lint = list(map(int, line.split()))
-            job_dict[i + 1] = [x for x in
-                               zip(lint[::2],  # machines
-                                   lint[1::2]  # operation lengths
-                                   )]
-        return job_dict
+            jobs.append((i + 1, tuple(zip(lint[::2],  # machines
+                                          lint[1::2]  # operation lengths
+                                          ))))
+    return tuple(jobs)
 
 
 def transformToMachineDict(jobs: dict, solution: dict) -> dict:
@@ -45,6 +58,12 @@ def transformToMachineDict(jobs: dict, solution: dict) -> dict:
 
 
 def find_time_window(jobs: dict, solution: dict, start: int, end: int):
+    """Cuts the part of a solution lying in [start, end) out as a sub-instance.
+
+    The result only depends on operations overlapping [start, end), sweeps
+    keep it per window and drop it with invalidate_windows when those
+    operations move.
+    """
     new_jobs = defaultdict(list)
     operations_indexes = defaultdict(list)
 
@@ -52,8 +71,9 @@ def find_time_window(jobs: dict, solution: dict, start: int, end: int):
     # because it is already taken by an operation that is happening during start 
     # or end of time window. Therefore, you can't find them in jobs: dict 
     # (instance dictionary), because they are removed from it.
-    disable_till = defaultdict(int)
-    disable_since = defaultdict(lambda: inf)
+    # Machines that aren't taken at either end of the window have no entry.
+    disable_till = {}
+    disable_since = {}
 
     # When an operation is scheduled during start or end of time window,
     # it's previous and subsequent operations are restricted to not last
@@ -61,33 +81,39 @@ def find_time_window(jobs: dict, solution: dict, start: int, end: int):
     disabled_variables = []
 
     for job_name, start_times in solution.items():
+        operations = jobs[job_name]
         for i, start_time in enumerate(start_times):
 
-            machine = jobs[job_name][i][0]
-            end_time = start_time + jobs[job_name][i][1]
+            machine, length = operations[i]
+            end_time = start_time + length
 
             if start_time >= start and end_time <= end:
                 # an operation fits into the time window
-                new_jobs[job_name].append(jobs[job_name][i])
+                new_jobs[job_name].append(operations[i])
                 operations_indexes[job_name].append(i)
 
             elif (start <= start_time < end and end_time > end):
-                # an operation reaches out of the time window from right side
-                if i > 0:
-                    for x in range(start_time - jobs[job_name][i - 1][1] + 1, end):
-                        disabled_variables.append(get_label(Task(
-                            job_name, i - 1, jobs[job_name][i - 1][0], jobs[job_name][i - 1][1]), x - start))
-                disable_since[machine] = min(
-                    disable_since[machine], start_time - start)
+                # an operation reaches out of the time window from right side,
+                # the previous operation of its job has to end before it starts
+                # (if that one is in the sub-instance, it's labelled with its
+                # position there)
+                indexes = operations_indexes.get(job_name)
+                if indexes and indexes[-1] == i - 1:
+                    previous = Task(job_name, len(indexes) - 1, *operations[i - 1])
+                    disabled_variables.extend(
+                        get_label(previous, x - start)
+                        for x in range(start_time - previous.duration + 1, end))
+                if start_time - start < disable_since.get(machine, inf):
+                    disable_since[machine] = start_time - start
 
             elif start_time < start and start < end_time <= end:
                 # an operation reaches out of the time window from the left side
                 if i < len(start_times) - 1:
-                    for x in range(end_time - start):
-                        disabled_variables.append(get_label(Task(
-                            job_name, 0, jobs[job_name][i + 1][0], jobs[job_name][i + 1][1]), x))
-                disable_till[machine] = max(
-                    disable_till[machine], end_time - start)
+                    following = Task(job_name, 0, *operations[i + 1])
+                    disabled_variables.extend(
+                        get_label(following, x) for x in range(end_time - start))
+                if end_time - start > disable_till.get(machine, 0):
+                    disable_till[machine] = end_time - start
 
             # If an operation reaches out of the time window from both sides,
             # do nothing, it's not going to be a problem
@@ -95,6 +121,79 @@ def find_time_window(jobs: dict, solution: dict, start: int, end: int):
     return new_jobs, operations_indexes, disable_till, disable_since, disabled_variables
 
 
+def active_windows(jobs: dict, solution: dict, window_size: int,
+                   num_windows: int) -> set:
+    """Returns the starts (below num_windows) of windows of size window_size
+    that fully contain at least one operation, the only ones for which
+    find_time_window returns a non-empty sub-instance.
+    """
+    # an operation [s, e) fits into windows starting in [e - window_size, s],
+    # those ranges are marked in a difference array
+    marks = [0] * (num_windows + 1)
+    for job, start_times in solution.items():
+        for (_, length), start_time in zip(jobs[job], start_times):
+            first = max(0, start_time + length - window_size)
+            last = min(num_windows - 1, start_time)
+            if first <= last:
+                marks[first] += 1
+                marks[last + 1] -= 1
+
+    active = set()
+    covering = 0
+    for window_start in range(num_windows):
+        covering += marks[window_start]
+        if covering:
+            active.add(window_start)
+    return active
+
+
+def invalidate_windows(windows: dict, start: int, end: int, window_size: int):
+    """Drops cached find_time_window results of all windows of size window_size
+    overlapping [start, end), the span in which operations were moved.
+
+    Args:
+        windows (dict): {window_start: find_time_window(...) result}
+    """
+    for window_start in [k for k in windows
+                         if k < end and k + window_size > start]:
+        del windows[window_start]
+
+
+def apply_window_solution(jobs: dict, solution: dict, task_times: dict,
+                          indexes: dict, start: int):
+    """Injects a solution of a sub-instance cut out by find_time_window
+    back into the full solution.
+
+    Args:
+        jobs (dict): description of an instance
+
+        solution (dict): solution to an instance, left unchanged
+
+        task_times (dict): start times of the sub-instance's operations,
+        relative to the start of the time window:
+        {("job_1", index_in_sub_instance): start_time, ...}
+
+        indexes (dict): full-instance indexes of the sub-instance's operations,
+        as returned by find_time_window
+
+        start (int): start of the time window
+
+    Returns:
+        dict: the improved solution, or None if it isn't valid;
+        rows of jobs untouched by the window are shared with solution
+    """
+    # copy-on-write: only rows of jobs present in the window are copied
+    sol_found = dict(solution)
+    for job in indexes:
+        sol_found[job] = solution[job][:]
+    for (job, j), time in task_times.items():
+        sol_found[job][indexes[job][j]] = time + start
+
+    if checkValidity(jobs, sol_found):
+        return sol_found
+    return None
+
+
 def solve_greedily(jobs: dict):
     max_time = 0
     for job in jobs.values():
@@ -208,40 +307,40 @@ def checkValidity(jobs: dict, solution: dict) -> bool:
     """
     # checking if order of operations in jobs is preserved
     for job, operations in jobs.items():
-        for i, (operation1, operation2) in enumerate(list(zip(operations[:-1], operations[1:]))):
-            if solution[job][i] + operation1[1] > solution[job][i+1]:
+        start_times = solution[job]
+        for i in range(len(operations) - 1):
+            if start_times[i] + operations[i][1] > start_times[i + 1]:
                 return False
     
-    machineDict = transformToMachineDict(jobs, solution)
-
-    # checking if no operations using the same machine intersect
-    for machine, operations in machineDict.items():
-        for i, operation1 in enumerate(operations):
-            for j, operation2 in enumerate(operations):
-                if i == j:
-                    continue
-                if not (operation1[1] + operation1[2] <= operation2[1] or # ends before
-                        operation2[1] + operation2[2] <= operation1[1]):  # starts after
-                    return False
+    # checking if no operations using the same machine intersect:
+    # time units a machine is busy are kept as set bits of an int,
+    # an operation conflicts if any of its units is already set
+    busy = {}
+    for job, operations in jobs.items():
+        for (machine, length), start in zip(operations, solution[job]):
+            if start < 0:
+                return False
+            units = ((1 << length) - 1) << start
+            machine_busy = busy.get(machine, 0)
+            if machine_busy & units:
+                return False
+            busy[machine] = machine_busy | units
     return True
 
 
 def get_result(jobs, solution):
-    max_time = 0
-    for job, operations in jobs.items():
-        max_time = max(max_time, solution[job][-1] + int(operations[-1][1]))
-    return max_time
+    # end of the last operation of every job, the latest one is the makespan
+    return max((solution[job][-1] + int(operations[-1][1])
+                for job, operations in jobs.items()), default=0)
 
 
 def get_order(solution):
-    order = []
-    for job, start_times in solution.items():
-        for i, start_time in enumerate(start_times):
-            order.append((start_time, (job, i)))
-        # order.extend([(value[x], (key, x)) for x in range(len(value))])
-    order.sort()
-    res = [x[1] for x in order]
-    return res
+    # operations listed in the solution's order, then stably sorted by start
+    # time (ties keep the order of jobs in the solution and of their
+    # operations), comparing ints instead of tuples
+    order = [(job, i) for job, starts in solution.items() for i in range(len(starts))]
+    start_times = [start for starts in solution.values() for start in starts]
+    return [order[k] for k in sorted(range(len(order)), key=start_times.__getitem__)]
 
 
 def get_order_numbered(solution):
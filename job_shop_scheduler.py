@@ -1,19 +1,20 @@
 from __future__ import print_function
 
-from bisect import bisect_right
 from os import PathLike
-import dwavebinarycsp
+import dimod
+import numpy as np
 
 
-def get_jss_bqm(job_dict, max_time, disable_till=None, disable_since=None, disabled_variables=None, stitch_kwargs=None):
+def get_jss_bqm(job_dict, max_time, disable_till=None, disable_since=None, disabled_variables=None, lagrange=2):
     """Returns a BQM to the Job Shop Scheduling problem.
     Args:
         job_dict: A dict. Contains the jobs we're interested in scheduling. (See Example below.)
         max_time: An integer. The upper bound on the amount of time the schedule can take.
-        stitch_kwargs: A dict. Kwargs to be passed through get_jss_bqm to dwavebinarycsp.stitch.
+        lagrange: A positive number. Penalty for breaking any of the constraints, the
+          makespan penalty is scaled to always stay below it.
     Returns:
-        A dimod.BinaryQuadraticModel. Note: The nodes in the BQM are labelled in the format,
-          <job_name>_<task_number>,<time>. (See Example below)
+        A dimod.BinaryQuadraticModel. Note: The nodes in the BQM are labelled with tuples,
+          (<job_name>, <task_number>, <time>). (See Example below)
     Example:
         'jobs' dict describes the jobs we're interested in scheduling. Namely, the dict key is the
          name of the job and the dict value is the ordered list of tasks that the job must do.
@@ -25,27 +26,26 @@ def get_jss_bqm(job_dict, max_time, disable_till=None, disable_since=None, disab
                    "b": [("mixer", 1)],
                    "c": [("oven", 2)]}
         >>> max_time = 4	  # Put an upperbound on how long the schedule can be
-        >>> bqm = get_jss_bqm(jobs, max_time, stitch_kwargs)
+        >>> bqm = get_jss_bqm(jobs, max_time)
         >>> # May need to tweak the chain strength and the number of reads
         >>> sampler = EmbeddingComposite(DWaveSampler())
         >>> sampleset = sampler.sample(bqm, chain_strength=2, num_reads=1000)
         >>> # Results
-        >>> # Note: Each node follows the format <job_name>_<task_number>,<time>.
-        >>> print(sampleset)
-        c_0,0  b_0,1  c_0,1  b_0,3  c_0,2  b_0,0  b_0,2  a_1,2  a_1,3  a_1,1  a_0,0  a_1,0  a_0,1  a_0,2
-            1      0      0      0      0      0      1      1      0      0      1      0      0      0
+        >>> # Note: Each node follows the format (<job_name>, <task_number>, <time>).
+        >>> print(sampleset.first.sample)
+        {('c', 0, 0): 1, ('b', 0, 1): 0, ('c', 0, 1): 0, ('b', 0, 3): 0, ('b', 0, 2): 1, ...}
         Interpreting Results:
-          Consider the node, "b_0,2" with a value of 1.
-          - "b_0,2" is interpreted as job b, task 0, at time 2
+          Consider the node, ('b', 0, 2) with a value of 1.
+          - ('b', 0, 2) is interpreted as job b, task 0, at time 2
           - Job b's 0th task is ("mixer", 1)
           - Hence, at time 2, Job b's 0th task is turned on
-          Consider the node, "a_1,0" with a value of 0.
-          - "a_1,0" is interpreted as job a, task 1, at time 0
+          Consider the node, ('a', 1, 0) with a value of 0.
+          - ('a', 1, 0) is interpreted as job a, task 1, at time 0
           - Job a's 1st task is ("oven", 1)
           - Hence, at time 0, Job a's 1st task is not run
     """
-    if stitch_kwargs is None:
-        stitch_kwargs = {}
+    if lagrange <= 0:
+        raise ValueError("lagrange has to be positive, got {}".format(lagrange))
     if disable_till is None:
         disable_till = {}
     if disable_since is None:
@@ -54,21 +54,21 @@ def get_jss_bqm(job_dict, max_time, disable_till=None, disable_since=None, disab
         disabled_variables = []
 
     scheduler = JobShopScheduler(job_dict, max_time)
-    return scheduler.get_bqm(disable_till, disable_since, disabled_variables, stitch_kwargs)
-
-
-def sum_to_one(*args):
-    return sum(args) == 1
+    return scheduler.get_bqm(disable_till, disable_since, disabled_variables, lagrange)
 
 
 def get_label(task, time):
-    """Creates a standardized name for variables in the constraint satisfaction problem,
-    JobShopScheduler.csp.
+    """Creates a standardized name for variables in the BQM built by JobShopScheduler.
+
+    Labels are (job, position, time) tuples rather than strings: they hash faster,
+    and samples can be unpacked directly without parsing.
     """
-    return f"{task.job}_{task.position},{time}"
+    return (task.job, task.position, time)
 
 
 class Task:
+    __slots__ = ('job', 'position', 'machine', 'duration')
+
     def __init__(self, job, position, machine, duration):
         self.job = job
         self.position = position
@@ -76,26 +76,8 @@ class Task:
         self.duration = duration
 
     def __repr__(self):
-        return ("{{job: {job}, position: {position}, machine: {machine}, duration:"
-                " {duration}}}").format(**vars(self))
-
-
-class KeyList:
-    """A wrapper to an array. Used for passing the key of a custom object to the bisect function.
-    Note: bisect function does not let you choose an arbitrary key, hence this class was created.
-    """
-
-    def __init__(self, array, key_function):
-        self.array = array  # An iterable
-        self.key_function = key_function  # Function for grabbing the key of a given item
-
-    def __len__(self):
-        return len(self.array)
-
-    def __getitem__(self, index):
-        item = self.array[index]
-        key = self.key_function(item)
-        return key
+        return ("{{job: {}, position: {}, machine: {}, duration: {}}}"
+                .format(self.job, self.position, self.machine, self.duration))
 
 
 class JobShopScheduler:
@@ -117,100 +99,156 @@ class JobShopScheduler:
                       "job_c": [("mach_2", 2), ("mach_1", 3), ("mach_2", 1)]}
         """
 
-        self.tasks = []
+        self.job_names = []
         self.last_task_indices = []
         self.max_time = max_time
-        self.csp = dwavebinarycsp.ConstraintSatisfactionProblem(
-            dwavebinarycsp.BINARY)
+        # BQM accumulated directly over variable ids, id = task_index * max_time + t;
+        # every constraint is a quadratic penalty. Ids are turned into labels
+        # once, in get_bqm
+        self.linear = None  # biases of all ids, allocated in _process_data
+        self.offset = 0
+        # Pair penalties as (u, v, bias) arrays of ids
+        self.pairs = []
 
-        # Populates self.tasks and self.max_time
+        # Populates the task arrays, self.task_indices, self.max_time and self.absurd_mask
 
         self._process_data(job_dict)
 
     def _process_data(self, jobs):
         """Process user input into a format that is more convenient for JobShopScheduler functions.
         """
-        # Create and concatenate Task objects
-        tasks = []
+        # Tasks are kept as parallel arrays: job id, position within the job,
+        # machine id and duration; job ids index self.job_names and machine ids
+        # are the values of self.machine_indices
+        job_ids = []
+        positions = []
+        machine_ids = []
+        durations = []
+        machine_indices = {}
         last_task_indices = [-1]    # -1 for zero-indexing
-        total_time = 0  # total time of all jobs
 
-        for job_name, job_tasks in jobs.items():
+        for job_id, (job_name, job_tasks) in enumerate(jobs.items()):
+            self.job_names.append(job_name)
             last_task_indices.append(last_task_indices[-1] + len(job_tasks))
 
             for i, (machine, time_span) in enumerate(job_tasks):
-                tasks.append(Task(job_name, i, machine, time_span))
-                total_time += time_span
+                job_ids.append(job_id)
+                positions.append(i)
+                machine_ids.append(machine_indices.setdefault(machine, len(machine_indices)))
+                durations.append(time_span)
 
         # Update values
-        self.tasks = tasks
+        self.job_ids = np.array(job_ids, dtype=np.int32)
+        self.positions = np.array(positions, dtype=np.int32)
+        self.machine_ids = np.array(machine_ids, dtype=np.int32)
+        self.durations = np.array(durations, dtype=np.int32)
+        self.machine_indices = machine_indices
         self.last_task_indices = last_task_indices[1:]
 
         if self.max_time is None:
-            self.max_time = total_time
-
-    def _add_one_start_constraint(self):
-        """self.csp gets the constraint: A task can start once and only once
+            self.max_time = sum(durations)   # total time of all jobs
+
+        # Reverse map of labels to rows of self.absurd_mask
+        self.task_indices = {(self.job_names[job_id], position): i
+                             for i, (job_id, position) in enumerate(zip(job_ids, positions))}
+        # absurd_mask[task_index, t]: start time t of a task can't be part of
+        # a valid schedule, the variable is left out of the BQM
+        self.absurd_mask = np.zeros((len(durations), self.max_time), dtype=bool)
+        # Start times of a task outside [t_lo, t_hi) are all absurd
+        self.t_lo = np.zeros(len(durations), dtype=np.int64)
+        self.t_hi = np.full(len(durations), self.max_time, dtype=np.int64)
+        self.linear = np.zeros(self.absurd_mask.size)
+
+    def _label(self, task_index, time):
+        """get_label of the task at task_index.
         """
-        for task in self.tasks:
-            task_times = {get_label(task, t) for t in range(self.max_time)}
-            self.csp.add_constraint(sum_to_one, task_times)
+        return (self.job_names[self.job_ids[task_index]],
+                int(self.positions[task_index]), time)
 
-    def _add_precedence_constraint(self):
-        """self.csp gets the constraint: Task must follow a particular order.
-         Note: assumes self.tasks are sorted by jobs and then by position
+    def _add_pairs(self, task_index, other_index, forbidden, bias):
+        """Queues bias on the interactions of all start time pairs
+        forbidden[t, tt] of two tasks, skipping absurd times.
+        Only the feasible ranges of both tasks are looked at.
         """
-        valid_edges = {(0, 0), (1, 0), (0, 1)}
-        for current_task, next_task in zip(self.tasks, self.tasks[1:]):
-            if current_task.job != next_task.job:
-                continue
+        lo, hi = self.t_lo[task_index], self.t_hi[task_index]
+        other_lo, other_hi = self.t_lo[other_index], self.t_hi[other_index]
+        ts, tts = np.nonzero(forbidden[lo:hi, other_lo:other_hi]
+                             & ~self.absurd_mask[task_index, lo:hi][:, None]
+                             & ~self.absurd_mask[other_index, other_lo:other_hi][None, :])
+        self.pairs.append((task_index * self.max_time + lo + ts,
+                           other_index * self.max_time + other_lo + tts,
+                           np.full(len(ts), bias, dtype=float)))
+
+    def _add_one_start_constraint(self, lagrange):
+        """BQM gets the constraint: A task can start once and only once
+
+        Penalty lagrange * (sum_t x_t - 1)^2, expanded using x^2 = x:
+        -lagrange per variable, 2 * lagrange per pair of variables
+        and lagrange as a constant.
+        """
+        for ti in range(len(self.durations)):
+            lo, hi = self.t_lo[ti], self.t_hi[ti]
+            task_times = ti * self.max_time + lo + np.flatnonzero(~self.absurd_mask[ti, lo:hi])
+
+            self.offset += lagrange
+            self.linear[task_times] -= lagrange
+            # all pairs of the task's start times
+            i, j = np.triu_indices(len(task_times), k=1)
+            self.pairs.append((task_times[i], task_times[j],
+                               np.full(len(i), 2 * lagrange, dtype=float)))
+
+    def _add_precedence_constraint(self, lagrange):
+        """BQM gets the constraint: Task must follow a particular order.
+         Note: assumes tasks are sorted by jobs and then by position
+
+        A forbidden pair of start times is penalized with lagrange * x * y.
+        """
+        # All (t, tt) start time pairs of two tasks
+        t = np.arange(self.max_time)[:, None]
+        tt = np.arange(self.max_time)[None, :]
 
-            # Forming constraints with the relevant times of the next task
-            for t in range(self.max_time):
-                current_label = get_label(current_task, t)
+        durations = self.durations.tolist()
+        # Tasks followed by another task of the same job
+        for ti in np.flatnonzero(self.job_ids[:-1] == self.job_ids[1:]).tolist():
+            # The next task can't start before the current one ends
+            self._add_pairs(ti, ti + 1, tt < t + durations[ti], lagrange)
 
-                for tt in range(min(t + current_task.duration, self.max_time)):
-                    next_label = get_label(next_task, tt)
-                    self.csp.add_constraint(
-                        valid_edges, {current_label, next_label})
+    def _add_share_machine_constraint(self, lagrange):
+        """BQM gets the constraint: At most one task per machine per time unit
 
-    def _add_share_machine_constraint(self):
-        """self.csp gets the constraint: At most one task per machine per time unit
+        A pair of overlapping start times is penalized with lagrange * x * y.
         """
-        sorted_tasks = sorted(self.tasks, key=lambda x: x.machine)
-        # Key wrapper for bisect function
-        wrapped_tasks = KeyList(sorted_tasks, lambda x: x.machine)
-
-        head = 0
-        valid_values = {(0, 0), (1, 0), (0, 1)}
-        while head < len(sorted_tasks):
-
-            # Find tasks that share a machine
-            tail = bisect_right(wrapped_tasks, sorted_tasks[head].machine)
-            same_machine_tasks = sorted_tasks[head:tail]
+        # All (t, tt) start time pairs of two tasks
+        t = np.arange(self.max_time)[:, None]
+        tt = np.arange(self.max_time)[None, :]
 
-            # Update
-            head = tail
+        # Find tasks that share a machine: group task indices by machine id
+        order = np.argsort(self.machine_ids, kind='stable')
+        bounds = np.flatnonzero(np.diff(self.machine_ids[order])) + 1
 
+        durations = self.durations.tolist()
+        t_lo, t_hi = self.t_lo.tolist(), self.t_hi.tolist()
+        for same_machine_tasks in np.split(order, bounds):
             # No need to build coupling for a single task
             if len(same_machine_tasks) < 2:
                 continue
 
-            # Apply constraint between all tasks for each unit of time
-            for task in same_machine_tasks:
-                for other_task in same_machine_tasks:
-                    if task.job == other_task.job and task.position == other_task.position:
+            # Apply constraint between every pair of tasks (once per pair)
+            same_machine_tasks = same_machine_tasks.tolist()
+            for i, ti in enumerate(same_machine_tasks):
+                for oti in same_machine_tasks[i + 1:]:
+                    # Skip pairs that can't overlap anyway: one of them always
+                    # ends before the other one can start
+                    if (t_lo[ti] >= t_hi[oti] - 1 + durations[oti]
+                            or t_lo[oti] >= t_hi[ti] - 1 + durations[ti]):
                         continue
 
-                    for t in range(self.max_time):
-                        current_label = get_label(task, t)
-
-                        for tt in range(t, min(t + task.duration, self.max_time)):
-                            self.csp.add_constraint(valid_values, {current_label,
-                                                                   get_label(other_task, tt)})
+                    # The tasks can't run at the same time
+                    overlap = (tt < t + durations[ti]) & (t < tt + durations[oti])
+                    self._add_pairs(ti, oti, overlap, lagrange)
 
     def _remove_absurd_times(self, disable_till: dict, disable_since, disabled_variables):
-        """Sets impossible task times in self.csp to 0.
+        """Marks impossible task times in self.absurd_mask.
 
         Args:
             disabled_times (dict):
@@ -220,73 +258,76 @@ class JobShopScheduler:
              "machine_2": [(s1, e1), (s2, e2)],
              "machine_3": [(s1, e1), (s2, e2)]}
         """
+        job_ids = self.job_ids.tolist()
+        durations = self.durations.tolist()
+
         # Times that are too early for task
         predecessor_time = 0
-        current_job = self.tasks[0].job
-        for task in self.tasks:
+        current_job = job_ids[0]
+        for ti, job_id in enumerate(job_ids):
             # Check if task is in current_job
-            if task.job != current_job:
+            if job_id != current_job:
                 predecessor_time = 0
-                current_job = task.job
+                current_job = job_id
 
-            for t in range(predecessor_time):
-                label = get_label(task, t)
-                self.csp.fix_variable(label, 0)
+            self.absurd_mask[ti, :predecessor_time] = True
 
-            predecessor_time += task.duration
+            predecessor_time += durations[ti]
 
         # Times that are too late for task
         # Note: we are going through the task list backwards in order to compute
         # the successor time
         # start with -1 so that we get (total task time - 1)
         successor_time = -1
-        current_job = self.tasks[-1].job
-        for task in self.tasks[::-1]:
+        current_job = job_ids[-1]
+        for ti in range(len(job_ids) - 1, -1, -1):
             # Check if task is in current_job
-            if task.job != current_job:
+            if job_ids[ti] != current_job:
                 successor_time = -1
-                current_job = task.job
+                current_job = job_ids[ti]
 
-            successor_time += task.duration
-            for t in range(successor_time):
-                # -1 for zero-indexed time
-                label = get_label(task, (self.max_time - 1) - t)
-                self.csp.fix_variable(label, 0)
+            successor_time += durations[ti]
+            self.absurd_mask[ti, max(0, self.max_time - successor_time):] = True
 
         # Times that are interfering with disabled regions
         # disabled variables, disable_till and disable_since
         # are explained in instance_parser.py
-        for task in self.tasks:
-            if task.machine in disable_till.keys():
-                for i in range(disable_till[task.machine]):
-                    label = get_label(task, i)
-                    if label in self.csp.variables:
-                        self.csp.fix_variable(label, 0)
-            elif task.machine in disable_since.keys():
-                for i in range(disable_since[task.machine], self.max_time):
-                    label = get_label(task, i)
-                    if label in self.csp.variables:
-                        self.csp.fix_variable(label, 0)
+        times = np.arange(self.max_time)
+        for machine, till in disable_till.items():
+            if machine in self.machine_indices:
+                on_machine = self.machine_ids == self.machine_indices[machine]
+                self.absurd_mask[on_machine, :till] = True
+        for machine, since in disable_since.items():
+            if machine in self.machine_indices:
+                on_machine = self.machine_ids == self.machine_indices[machine]
+                # tasks have to end before the machine is taken
+                latest = since - self.durations[on_machine]
+                self.absurd_mask[on_machine] |= times[None, :] > latest[:, None]
 
         # Times that are manually disabled
-        for label in disabled_variables:
-            if label in self.csp.variables:
-                self.csp.fix_variable(label, 0)
-
-    def get_bqm(self, disable_till, disable_since, disabled_variables, stitch_kwargs=None):
+        for job, position, t in disabled_variables:
+            ti = self.task_indices.get((job, position))
+            if ti is not None and 0 <= t < self.max_time:
+                self.absurd_mask[ti, t] = True
+
+        # Feasible ranges: first allowed time and one past the last one
+        # (an empty range if there is none)
+        allowed = ~self.absurd_mask
+        self.t_lo = allowed.argmax(axis=1)
+        self.t_hi = np.where(allowed.any(axis=1),
+                             self.max_time - allowed[:, ::-1].argmax(axis=1), self.t_lo)
+
+    def get_bqm(self, disable_till, disable_since, disabled_variables, lagrange=2):
         """Returns a BQM to the Job Shop Scheduling problem.
         Args:
-            stitch_kwargs: A dict. Kwargs to be passed to dwavebinarycsp.stitch.
+            lagrange: A positive number. Penalty for breaking any of the constraints,
+              see get_jss_bqm.
         """
-        if stitch_kwargs is None:
-            stitch_kwargs = {}
-
-        # Apply constraints to self.csp
-        self._add_one_start_constraint()
-        self._add_precedence_constraint()
-        self._add_share_machine_constraint()
+        # Absurd times are marked first, so the constraints skip them
         self._remove_absurd_times(disable_till, disable_since, disabled_variables)
-        bqm = dwavebinarycsp.stitch(self.csp, **stitch_kwargs)
+        self._add_one_start_constraint(lagrange)
+        self._add_precedence_constraint(lagrange)
+        self._add_share_machine_constraint(lagrange)
 
         # Edit BQM to encourage the shortest schedule
         # Overview of this added penalty:
@@ -324,22 +365,42 @@ class JobShopScheduler:
         #
         # - Therefore, with this penalty scheme, all optimal solution penalties < any non-optimal
         #   solution penalties
+        #
+        # - The whole scheme is scaled by lagrange / base, which doesn't change the argument
+        #   above. Each last task then gets at most lagrange / (N+1), so the penalty of any
+        #   schedule stays below lagrange. Breaking a constraint costs at least lagrange, so it
+        #   can never pay off by shortening the schedule (e.g. by leaving a last task out).
         base = len(self.last_task_indices) + 1     # Base for exponent
-        # Get our pruned (remove_absurd_times) variable list so we don't undo pruning
-        pruned_variables = list(bqm.variables)
-        for i in self.last_task_indices:
-            task = self.tasks[i]
-
-            for t in range(self.max_time):
-                end_time = t + task.duration
-
-                # Check task's end time; do not add in absurd times
-                if end_time > self.max_time:
-                    continue
-
-                # Add bias to variable
-                bias = 2 * base**(end_time - self.max_time)
-                label = get_label(task, t)
-                if label in pruned_variables:
-                    bqm.add_variable(label, bias)
-        return bqm
+        last_tasks = np.array(self.last_task_indices, dtype=np.int64)
+        end_times = np.arange(self.max_time)[None, :] + self.durations[last_tasks][:, None]
+
+        # Check task's end time; do not add in absurd times and
+        # do not undo pruning (remove_absurd_times)
+        valid = (end_times <= self.max_time) & ~self.absurd_mask[last_tasks]
+
+        # Add bias to variables, rows of linear are tasks
+        # base ** (end_time - max_time) looked up by end time (0..max_time),
+        # masked out overruns are clipped to stay in the table
+        powtab = np.float_power(base, np.arange(-self.max_time, 1))
+        bias = lagrange / base * powtab[np.minimum(end_times, self.max_time)]
+        self.linear.reshape(self.absurd_mask.shape)[last_tasks] += np.where(valid, bias, 0)
+
+        # All interactions as arrays of ids
+        us, vs, biases = (np.concatenate(arrays) for arrays in zip(*self.pairs))
+
+        # Merging duplicate (and swapped) pairs by summing their biases
+        size = self.absurd_mask.size
+        keys = np.minimum(us, vs) * size + np.maximum(us, vs)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        biases = np.bincount(inverse, weights=biases)
+
+        # Variables that are not absurd, numbered 0..n-1 in the BQM
+        variables = np.flatnonzero(~self.absurd_mask.ravel())
+        index = np.full(size, -1)
+        index[variables] = np.arange(len(variables))
+
+        # Labels are built once, for the variables of the BQM
+        labels = [self._label(*divmod(v, self.max_time)) for v in variables.tolist()]
+        return dimod.BinaryQuadraticModel.from_numpy_vectors(
+            self.linear[variables], (index[keys // size], index[keys % size], biases),
+            self.offset, dimod.BINARY, variable_order=labels)
@@ -1,97 +1,262 @@
+import dimod
 import neal
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 from dwave.system.composites import EmbeddingComposite
 from dwave.system.samplers import DWaveSampler
-from dwavebinarycsp.exceptions import ImpossibleBQM
 
 from job_shop_scheduler import get_jss_bqm
 
 from instance_parser import *
 
-from pprint import pprint
+from random import shuffle
+
+# window BQMs up to this size are solved by enumerating all their states
+# instead of simulated annealing
+EXACT_SOLVER_MAX_VARIABLES = 10
+
+
+def _parse_sample(sample, new_jobs):
+    """Reads the start times of the tasks of a window from a sample.
+
+    Returns:
+        task_times (dict): {(job, task_index): start_time, ...}
+        start times are relative to the window; None if the sample doesn't
+        start every task exactly once
+    """
+    # parsing variables that were selected by the sampler in a single pass
+    task_times = {}
+    for label, value in sample.items():
+        if value != 1:
+            continue
+        job_name, task_index, start_time = label
+        if (job_name, task_index) in task_times:  # task started twice
+            return None
+        task_times[job_name, task_index] = start_time
+
+    if len(task_times) != sum(len(tasks) for tasks in new_jobs.values()):
+        return None
+    return task_times
+
+
+def _sample_and_parse(sampler, bqm, new_jobs, sample_kwargs):
+    """Samples a window BQM and reads the start times of its tasks
+    from the best (lowest energy) sample.
+
+    Returns:
+        task_times (dict): as returned by _parse_sample
+    """
+    if not bqm.quadratic:
+        # without interactions every variable is minimized independently,
+        # ties are broken towards starting the task
+        low, high = sorted(bqm.vartype.value)
+        solution1 = {v: high if bias <= 0 else low
+                     for v, bias in bqm.linear.items()}
+    elif (isinstance(sampler, neal.SimulatedAnnealingSampler)
+          and len(bqm) <= EXACT_SOLVER_MAX_VARIABLES):
+        # cheaper than setting up an anneal, and exact (the QPU is always
+        # sampled); the lowest energy sample that starts every task exactly
+        # once is used, so that ties with other states can't hide it
+        sampleset = dimod.ExactSolver().sample(bqm)
+        for sample, in sampleset.data(['sample'], sorted_by='energy'):
+            task_times = _parse_sample(sample, new_jobs)
+            if task_times is not None:
+                return task_times
+        return None
+    else:
+        # reding num_reads responses from the sampler
+        sampleset = sampler.sample(bqm, **sample_kwargs)
+
+        # using the best (lowest energy) sample
+        solution1 = sampleset.first.sample
+
+    return _parse_sample(solution1, new_jobs)
+
+
+@lru_cache(maxsize=256)
+def _window_bqm(jobs, max_time, disable_till, disable_since, disabled_variables,
+                lagrange):
+    """get_jss_bqm memoized on a hashable signature of a sub-instance,
+    windows seen again in later sweeps are only resampled, not rebuilt.
+    Samplers don't modify the BQM, so cached models are shared as they are.
+    """
+    return get_jss_bqm(dict(jobs), max_time, dict(disable_till), dict(disable_since),
+                       list(disabled_variables), lagrange=lagrange)
+
+
+def _solve_window(new_jobs, disable_till, disable_since, disabled_variables,
+                  window_size, lagrange, sampler, sample_kwargs):
+    """Builds the BQM of a sub-instance cut out by find_time_window and samples it.
+
+    Returns:
+        task_times (dict): as returned by _parse_sample, or None if
+        no valid schedule of the sub-instance was found
+    """
+    # constructing Binary Quadratic Model
+    bqm = _window_bqm(tuple((job, tuple(tasks)) for job, tasks in new_jobs.items()),
+                      window_size + 1,
+                      frozenset(disable_till.items()),
+                      frozenset(disable_since.items()),
+                      frozenset(disabled_variables),
+                      lagrange)
+
+    return _sample_and_parse(sampler, bqm, new_jobs, sample_kwargs)
+
+
+def _solve_window_in_worker(args):
+    """Process pool entry point of _solve_window, sampling with simulated annealing.
+    """
+    return _solve_window(*args[:-1], neal.SimulatedAnnealingSampler(), args[-1])
+
+
+def _disjoint_batches(starts, length):
+    """Greedily groups window starts into batches of pairwise disjoint
+    windows [start, start + length), keeping their order otherwise.
+    """
+    batches = []
+    for start in starts:
+        for batch in batches:
+            if all(abs(start - other) >= length for other in batch):
+                batch.append(start)
+                break
+        else:
+            batches.append([start])
+    return batches
 
-from copy import deepcopy
 
 def solve_with_pbruteforce(jobs, solution, qpu=False, num_reads=2000,
                            max_time=None, window_size=5, chain_strength=2,
-                           num_of_iterations=10, min_classical_gap=2):
+                           num_of_iterations=10, lagrange=2,
+                           num_sweeps=200, seed=None, workers=1):
+    """Improves a solution by rescheduling tasks in small time windows,
+    one window (a sub-instance) at a time.
+
+    With workers > 1 (simulated annealing only) non-overlapping windows are
+    sampled in parallel processes and their results are applied one by one.
+
+    lagrange is the constraint penalty of the window BQMs (see get_jss_bqm),
+    any positive value keeps valid schedules as their ground states.
+
+    num_sweeps is the number of simulated annealing sweeps per read, 200
+    by default instead of neal's 1000 since window BQMs are small; it is
+    ignored on the QPU.
+
+    seed seeds simulated annealing, offset by the iteration number so that
+    every sweep over the instance draws different samples while whole runs
+    stay reproducible; None (default) leaves sampling unseeded. It is
+    ignored on the QPU.
+
+    Yields:
+        tuple: every accepted solution and the start of its window
+    """
 
     # default, safe value of max_time to give some room for improvement
     if max_time is None:
         max_time = get_result(jobs, solution) + 3
 
-    # main loop, iterates over whole instance
-    for iteration_number in range(num_of_iterations):
-        print('-'*10, f"iteration {iteration_number+1}/{num_of_iterations}",'-'*10)
-        try:
-            if qpu:
-                sampler = EmbeddingComposite(DWaveSampler())
-            else:
-                sampler = neal.SimulatedAnnealingSampler()
-
-            # looping over parts of the instance, solving small sub-instances
-            # of size window_size
-            from random import sample
-            for i in sample(range(max_time - window_size), len(range(max_time -
-                                                                     window_size))):
-
-                # cutting out the sub-instance
-                info = find_time_window(jobs, solution, i, i + window_size)
-
-                # new_jobs - tasks present in the sub-instance
-                # indexes - old (full-instance) indexes of tasks in new_jobs
-                # disable_till, disable_since and disabled_variables are all
-                # explained in instance_parser.py
-                new_jobs, indexes, disable_till, disable_since, disabled_variables = info
-
-                if not bool(new_jobs):  # if sub-instance is empty
-                    continue
-
-                # constructing Binary Quadratic Model
-                try:
-                    bqm = get_jss_bqm(new_jobs, window_size + 1, disable_till, disable_since,
-                                      disabled_variables,
-                                      stitch_kwargs={'min_classical_gap':
-                                                     min_classical_gap})
-                except ImpossibleBQM:
-                    print('*' * 25 + " It's impossible to construct a BQM " + '*' * 25)
-                    continue
-
-                # reding num_reads responses from the sampler
-                sampleset = sampler.sample(bqm, chain_strength=chain_strength,
-                                           num_reads=num_reads)
-
-                # using the best (lowest energy) sample 
-                solution1 = sampleset.first.sample
-
-                # variables that were selected by the sampler
-                # (apart from the auxiliary variables)
-                selected_nodes = [k for k, v in solution1.items() if v ==
-                                  1 and not k.startswith('aux')]
-
-                # parsing aquired information
-                task_times = {k: [-1] * len(v) for k, v in new_jobs.items()}
-                for node in selected_nodes:
-                    job_name, task_time = node.rsplit("_", 1)
-                    task_index, start_time = map(int, task_time.split(","))
-                    task_times[int(job_name)][task_index] = start_time
-
-                # constructing a new solution, improved by the aquired info
-                # newly scheduled tasks are injected into a full instance
-                sol_found = deepcopy(solution)
-                for job, times in task_times.items():
-                    for j in range(len(times)):
-                        sol_found[job][indexes[job][j]] = task_times[job][j] + i
-
-                # checking if the new, improved solution is valid
-                if checkValidity(jobs, sol_found):
-                    solution = deepcopy(sol_found)
-                    # solution = sol_found
-                    yield solution, i  # solution and current position of window
-
-        except Exception as e:
-            # uncomment this if you want to apply some behaviuor 
-            # in demo.py when exception occurs:
-            # yield 'ex', 'ex'
-            print(e)
-            continue
+    if qpu:
+        sample_kwargs = {'chain_strength': chain_strength,
+                         'num_reads': num_reads}
+    else:
+        # window BQMs are small (a few dozen variables), they converge
+        # in far fewer sweeps than neal's default of 1000
+        sample_kwargs = {'num_reads': num_reads,
+                         'num_sweeps': num_sweeps}
+
+    # find_time_window results per window start, kept while the solution
+    # doesn't change around them
+    windows = {}
+
+    # all window starts, reshuffled in place before every sweep
+    starts = list(range(max_time - window_size))
+    # windows that aren't empty, updated after every accepted change
+    active = active_windows(jobs, solution, window_size, len(starts))
+
+    sampler = None
+    executor = ProcessPoolExecutor(workers) if workers > 1 and not qpu else None
+
+    try:
+        # main loop, iterates over whole instance
+        for iteration_number in range(num_of_iterations):
+            print('-'*10, f"iteration {iteration_number+1}/{num_of_iterations}",'-'*10)
+            if seed is not None and not qpu:
+                sample_kwargs['seed'] = seed + iteration_number
+            try:
+                # created once and reused by all sweeps (for the QPU
+                # it resolves credentials and connects to the solver);
+                # if that fails it is retried in the next sweep.
+                # Worker processes create their own
+                if sampler is None and executor is None:
+                    if qpu:
+                        sampler = EmbeddingComposite(DWaveSampler())
+                    else:
+                        sampler = neal.SimulatedAnnealingSampler()
+
+                # looping over parts of the instance, solving small sub-instances
+                # of size window_size, in random order
+                shuffle(starts)
+
+                # a window moves tasks within [i, i + window_size + 1), windows
+                # solved together mustn't overlap so that the other windows'
+                # sub-instances stay exactly as they were cut out
+                if executor is None:
+                    batches = [[i] for i in starts]
+                else:
+                    batches = _disjoint_batches(starts, window_size + 1)
+
+                for batch in batches:
+                    # cutting out the sub-instances
+                    # new_jobs - tasks present in the sub-instance
+                    # indexes - old (full-instance) indexes of tasks in new_jobs
+                    # disable_till, disable_since and disabled_variables are all
+                    # explained in instance_parser.py
+                    cut_outs = []
+                    for i in batch:
+                        if i not in active:  # if sub-instance is empty
+                            continue
+                        if i not in windows:
+                            windows[i] = find_time_window(jobs, solution, i, i + window_size)
+                        new_jobs, indexes, disable_till, disable_since, disabled_variables = windows[i]
+
+                        if not bool(new_jobs):  # if sub-instance is empty
+                            continue
+                        cut_outs.append((i, indexes, (new_jobs, disable_till,
+                                                      disable_since,
+                                                      disabled_variables,
+                                                      window_size,
+                                                      lagrange)))
+
+                    if executor is None:
+                        results = (_solve_window(*window, sampler, sample_kwargs)
+                                   for _, _, window in cut_outs)
+                    else:
+                        results = executor.map(_solve_window_in_worker,
+                                               [window + (sample_kwargs,)
+                                                for _, _, window in cut_outs])
+
+                    for (i, indexes, _), task_times in zip(cut_outs, results):
+                        if task_times is None:  # sample violates the constraints
+                            continue
+
+                        # newly scheduled tasks are injected into a full instance
+                        sol_found = apply_window_solution(jobs, solution, task_times,
+                                                          indexes, i)
+                        if sol_found is not None:
+                            solution = sol_found
+                            # tasks only moved within the window's time span
+                            invalidate_windows(windows, i, i + window_size + 1, window_size)
+                            active = active_windows(jobs, solution, window_size,
+                                                    len(starts))
+                            yield solution, i  # solution and current position of window
+
+            except Exception as e:
+                # uncomment this if you want to apply some behaviuor 
+                # in demo.py when exception occurs:
+                # yield 'ex', 'ex'
+                print(e)
+                continue
+    finally:
+        if executor is not None:
+            executor.shutdown()
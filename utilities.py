@@ -1,27 +1,36 @@
+import numpy as np
 import plotly.express as px
 from instance_parser import get_result
-from datetime import datetime
 
 import plotly.figure_factory as ff
 
 
+# time units are drawn as days, starting from this date
+DAY_ZERO = np.datetime64('1971-01-01')
+
 def convert_to_datetime(x):
-  return datetime.fromtimestamp(31536000+x*24*3600).strftime("%Y-%m-%d")
+  # works on a single time unit as well as on a whole array of them
+  return np.datetime_as_string(DAY_ZERO + np.asarray(x, dtype='timedelta64[D]')).tolist()
 
 def draw_solution(jobs: dict, solution: dict, x_max=None, lines=[]):
-    df = []
     if x_max is None:
         x_max = get_result(jobs, solution)
+
+    # one column per field, dates converted for whole columns at once
+    machines, starts, finishes, job_names = [], [], [], []
     for job, tasks in solution.items():
-        for i, start in enumerate(tasks):
-            machine, length = jobs[job][i]
-            df.append(dict(Machine=machine,
-                           Start=convert_to_datetime(start),
-                           Finish=convert_to_datetime(start+length),
-                           Job=str(job)))
+        for (machine, length), start in zip(jobs[job], tasks):
+            machines.append(machine)
+            starts.append(start)
+            finishes.append(start+length)
+            job_names.append(str(job))
+    df = dict(Machine=machines,
+              Start=convert_to_datetime(starts),
+              Finish=convert_to_datetime(finishes),
+              Job=job_names)
 
     num_tick_labels = list(range(x_max+1))
-    date_ticks = [convert_to_datetime(x) for x in num_tick_labels]
+    date_ticks = convert_to_datetime(num_tick_labels)
 
     fig = px.timeline(df, y="Machine", x_start="Start", x_end="Finish", color="Job")
     fig.update_traces(marker=dict(line=dict(width=3, color='black')), opacity=0.5)